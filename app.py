@@ -1,41 +1,102 @@
+import eventlet
+eventlet.monkey_patch()
+
 import os
+import re
+import heapq
+import itertools
 import random
-import uuid
-import time
+import secrets
+import socket
 import threading
+import time
+import traceback
+import base64
+import functools
+from collections import OrderedDict, deque, namedtuple
+from contextlib import nullcontext
+import orjson
 from flask import Flask, render_template, request
-from flask_socketio import SocketIO, emit, join_room
+from flask_socketio import SocketIO, emit, join_room, leave_room
+
+class OrjsonCodec:
+    """json-module shim so Socket.IO packets are encoded with orjson."""
+    @staticmethod
+    def dumps(obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    @staticmethod
+    def loads(s, **kwargs):
+        return orjson.loads(s)
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'ludo-royal-2024')
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode='threading')
+# WebSocket only: no long-polling handshake or upgrade round trips. eventlet's
+# websocket server negotiates permessage-deflate itself whenever the browser offers it.
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode='eventlet', json=OrjsonCodec,
+                    transports=['websocket'])
+
+class NoDelayMiddleware:
+    """Sets TCP_NODELAY on each connection so small emits skip Nagle's delay.
+
+    Gunicorn hands over its socket as 'gunicorn.socket' (and already sets TCP_NODELAY
+    on its listener); `python app.py` runs eventlet's own server, which only
+    exposes it through 'eventlet.input'.
+    """
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        sock = environ.get('gunicorn.socket')
+        if sock is None:
+            conn = environ.get('eventlet.input')
+            sock = conn.get_socket() if conn is not None else None
+        if sock is not None:
+            try:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            except OSError:
+                pass   # not a TCP socket (e.g. unix socket behind a proxy)
+        return self.wsgi_app(environ, start_response)
+
+# Wrap outside the Socket.IO middleware so websocket upgrades are covered too
+app.wsgi_app = NoDelayMiddleware(app.wsgi_app)
 
 # ─────────────────────────────────────────────
 # CONSTANTS
 # ─────────────────────────────────────────────
 COLORS = ['red', 'blue', 'green', 'yellow']
-
-PATH = [
-    [6,1],[6,2],[6,3],[6,4],[6,5],
-    [5,6],[4,6],[3,6],[2,6],[1,6],[0,6],[0,7],
-    [0,8],[1,8],[2,8],[3,8],[4,8],[5,8],
-    [6,9],[6,10],[6,11],[6,12],[6,13],[6,14],[7,14],
-    [8,14],[8,13],[8,12],[8,11],[8,10],[8,9],
-    [9,8],[10,8],[11,8],[12,8],[13,8],[14,8],[14,7],
-    [14,6],[13,6],[12,6],[11,6],[10,6],[9,6],
-    [8,5],[8,4],[8,3],[8,2],[8,1],[8,0],[7,0],[6,0],
-]
-
-HOME_STRETCH = {
-    'red':    [[7,1],[7,2],[7,3],[7,4],[7,5],[7,6]],
-    'blue':   [[1,7],[2,7],[3,7],[4,7],[5,7],[6,7]],
-    'green':  [[13,7],[12,7],[11,7],[10,7],[9,7],[8,7]],
-    'yellow': [[7,13],[7,12],[7,11],[7,10],[7,9],[7,8]],
-}
-
-START_IDX = {'red': 0, 'blue': 13, 'yellow': 26, 'green': 39}
-ENTRY_BEFORE_HOME = {'red': 51, 'blue': 11, 'green': 37, 'yellow': 24}
+COLOR_IDX = {c: i for i, c in enumerate(COLORS)}
+
+# Board geometry as (row, col) cells. The client draws from its own copy (PATH/HS in
+# index.html); the server only ever deals in path indices, so these never go on the wire.
+PATH = (
+    (6,1),(6,2),(6,3),(6,4),(6,5),
+    (5,6),(4,6),(3,6),(2,6),(1,6),(0,6),(0,7),
+    (0,8),(1,8),(2,8),(3,8),(4,8),(5,8),
+    (6,9),(6,10),(6,11),(6,12),(6,13),(6,14),(7,14),
+    (8,14),(8,13),(8,12),(8,11),(8,10),(8,9),
+    (9,8),(10,8),(11,8),(12,8),(13,8),(14,8),(14,7),
+    (14,6),(13,6),(12,6),(11,6),(10,6),(9,6),
+    (8,5),(8,4),(8,3),(8,2),(8,1),(8,0),(7,0),(6,0),
+)
+
+# Per-color tables are tuples indexed by color index (COLORS order: red, blue, green, yellow)
+HOME_STRETCH = (
+    ((7,1),(7,2),(7,3),(7,4),(7,5),(7,6)),
+    ((1,7),(2,7),(3,7),(4,7),(5,7),(6,7)),
+    ((13,7),(12,7),(11,7),(10,7),(9,7),(8,7)),
+    ((7,13),(7,12),(7,11),(7,10),(7,9),(7,8)),
+)
+
+START_IDX         = (0, 13, 39, 26)
+ENTRY_BEFORE_HOME = (51, 11, 37, 24)
 SAFE_SQUARES = {0, 8, 13, 21, 26, 34, 39, 47}
+SAFE_MASK    = sum(1 << p for p in SAFE_SQUARES)   # test with (SAFE_MASK >> pos) & 1
+
+# Zobrist keys: one per (player*4 + token, square) plus one per finished token.
+# square == pos + 2 on the outer path / home base, 54 + stretch in the stretch.
+ZOBRIST          = [[random.getrandbits(64) for _ in range(60)] for _ in range(16)]
+ZOBRIST_FINISHED = [random.getrandbits(64) for _ in range(16)]
 
 # ─────────────────────────────────────────────
 # TOKEN STATE
@@ -45,37 +106,75 @@ SAFE_SQUARES = {0, 8, 13, 21, 26, 34, 39, 47}
 # finished → reached center
 # ─────────────────────────────────────────────
 
-def make_token(idx):
-    return {'id': idx, 'pos': -1, 'stretch': -1, 'finished': False}
-
-def make_player(color, is_cpu):
-    return {
-        'color': color,
-        'is_cpu': is_cpu,
-        'tokens': [make_token(i) for i in range(4)],
-        'finished_count': 0,
-        'sid': None,
-        'last_moved_token': None,          # track for triple-six penalty
-    }
+class Token:
+    __slots__ = ('id', 'pos', 'stretch', 'finished')
+
+    def __init__(self, idx):
+        self.id       = idx
+        self.pos      = -1
+        self.stretch  = -1
+        self.finished = False
+
+class Player:
+    __slots__ = ('color', 'ci', 'is_cpu', 'tokens', 'finished_count', 'sid', 'last_moved_token')
+
+    def __init__(self, color, is_cpu):
+        self.color            = color
+        self.ci               = COLOR_IDX[color]
+        self.is_cpu           = is_cpu
+        self.tokens           = [Token(i) for i in range(4)]
+        self.finished_count   = 0
+        self.sid              = None
+        self.last_moved_token = None   # track for triple-six penalty
+
+def token_hash(player_idx, token):
+    slot   = player_idx * 4 + token.id
+    square = token.pos + 2 if token.stretch < 0 else 54 + token.stretch
+    h = ZOBRIST[slot][square]
+    if token.finished:
+        h ^= ZOBRIST_FINISHED[slot]
+    return h
+
+def on_path(token):
+    return token.pos >= 0 and token.stretch < 0 and not token.finished
+
+def set_token(game, player_idx, token, pos, stretch, finished=None):
+    """Moves a token, keeping game['_state_hash'] and game['_occupancy'] in step."""
+    occ = game['_occupancy']
+    if on_path(token):
+        owners = occ[token.pos]
+        owners[player_idx].remove(token)
+        if not owners[player_idx]:
+            del owners[player_idx]
+            if not owners:
+                del occ[token.pos]
+
+    game['_state_hash'] ^= token_hash(player_idx, token)
+    token.pos     = pos
+    token.stretch = stretch
+    if finished is not None:
+        token.finished = finished
+    game['_state_hash'] ^= token_hash(player_idx, token)
+
+    if on_path(token):
+        occ.setdefault(pos, {}).setdefault(player_idx, []).append(token)
+    game['_dirty'].add((player_idx, token.id))
 
 # ─────────────────────────────────────────────
 # RULE 3 & 9: can this token move with this dice?
 # ─────────────────────────────────────────────
-def can_move(token, dice, color):
-    if token['finished']:
-        return False
-
+def _can_move_rule(pos, stretch, dice, ci):
     # Rule 3 & 9: token at home base needs a 6 to come out
-    if token['pos'] == -1:
+    if pos == -1:
         return dice == 6
 
     # Rule 7: token in home stretch — need exact count, no overshooting
-    if token['stretch'] >= 0:
-        return token['stretch'] + dice <= 5
+    if stretch >= 0:
+        return stretch + dice <= 5
 
     # Token on outer path — check if it can move without overshooting home stretch
-    entry = ENTRY_BEFORE_HOME[color]
-    steps_to_entry = (entry - token['pos']) % 52   # distance to entry square (0 if already there)
+    entry = ENTRY_BEFORE_HOME[ci]
+    steps_to_entry = (entry - pos) % 52   # distance to entry square (0 if already there)
 
     if dice <= steps_to_entry:
         return True   # stays on outer path or lands exactly on entry square
@@ -84,6 +183,79 @@ def can_move(token, dice, color):
     steps_into_stretch = dice - steps_to_entry - 1
     return steps_into_stretch <= 5
 
+# CAN_MOVE[ci][pos + 2][stretch + 1][dice] — pos -2..51, stretch -1..5, dice 0..6
+CAN_MOVE = tuple(
+    tuple(
+        tuple(
+            tuple(dice > 0 and _can_move_rule(pos, stretch, dice, ci) for dice in range(7))
+            for stretch in range(-1, 6))
+        for pos in range(-2, 52))
+    for ci in range(len(COLORS)))
+
+def _move_result_rule(pos, stretch, dice, ci):
+    """Returns (new_pos, new_stretch, finished) or None if the move is illegal."""
+    if not _can_move_rule(pos, stretch, dice, ci):
+        return None
+    if pos == -1:
+        return START_IDX[ci], -1, False
+    if stretch >= 0:
+        return -2, stretch + dice, stretch + dice == 5
+
+    steps_to_entry = (ENTRY_BEFORE_HOME[ci] - pos) % 52
+    if dice <= steps_to_entry:
+        return (pos + dice) % 52, -1, False
+    # Enter home stretch; pos == -2 marks a token inside it
+    steps_into_stretch = dice - steps_to_entry - 1
+    return -2, steps_into_stretch, steps_into_stretch == 5
+
+# MOVE_RESULT[ci][pos + 2][stretch + 1][dice] — same indexing as CAN_MOVE
+MOVE_RESULT = tuple(
+    tuple(
+        tuple(
+            tuple(_move_result_rule(pos, stretch, dice, ci) if dice > 0 else None
+                  for dice in range(7))
+            for stretch in range(-1, 6))
+        for pos in range(-2, 52))
+    for ci in range(len(COLORS)))
+
+def _progress_rule(pos, stretch, ci):
+    """How far along a token is, for the CPU's "advance furthest" rule; None at home base."""
+    if stretch >= 0:
+        return 1000 + stretch
+    if pos >= 0:
+        return (pos - START_IDX[ci]) % 52
+    return None
+
+# PROGRESS[ci][pos + 2][stretch + 1] — same indexing as CAN_MOVE, without the dice
+PROGRESS = tuple(
+    tuple(
+        tuple(_progress_rule(pos, stretch, ci) for stretch in range(-1, 6))
+        for pos in range(-2, 52))
+    for ci in range(len(COLORS)))
+
+def can_move(token, dice, ci):
+    if token.finished:
+        return False
+    return CAN_MOVE[ci][token.pos + 2][token.stretch + 1][dice]
+
+def movable_mask(player, dice):
+    """Bit i is set when token i can move with this dice."""
+    mask = 0
+    for i, t in enumerate(player.tokens):
+        if can_move(t, dice, player.ci):
+            mask |= 1 << i
+    return mask
+
+# ─────────────────────────────────────────────
+# BOARD QUERIES — answered from the occupancy index
+# ─────────────────────────────────────────────
+def tokens_at(game, pos, exclude_idx):
+    """Returns {player_idx: [token, ...]} for live outer-path tokens on pos."""
+    owners = game['_occupancy'].get(pos)
+    if not owners:
+        return {}
+    return {i: toks for i, toks in owners.items() if i != exclude_idx}
+
 # ─────────────────────────────────────────────
 # RULE 6: blocking — two same-color tokens on same square block opponents
 # ─────────────────────────────────────────────
@@ -91,109 +263,63 @@ def is_blocked(game, attacker_idx, new_pos):
     """Returns True if new_pos is blocked by 2+ enemy tokens."""
     if new_pos < 0:
         return False
-    for i, p in enumerate(game['players']):
-        if i == attacker_idx:
-            continue
-        count = sum(1 for t in p['tokens']
-                    if t['pos'] == new_pos and t['stretch'] < 0 and not t['finished'])
-        if count >= 2:
-            return True
-    return False
+    return any(len(toks) >= 2 for toks in tokens_at(game, new_pos, attacker_idx).values())
 
 # ─────────────────────────────────────────────
 # APPLY A MOVE — returns list of events
 # ─────────────────────────────────────────────
 def apply_move(game, player_idx, token_idx):
+    """Moves the token by the current dice; returns (events, winner color or None)."""
     player = game['players'][player_idx]
-    token  = player['tokens'][token_idx]
-    color  = player['color']
+    token  = player.tokens[token_idx]
+    color  = player.color
     dice   = game['dice_value']
     events = []
 
     # Record that this token was moved (for triple-six penalty)
-    player['last_moved_token'] = token_idx
+    player.last_moved_token = token_idx
 
-    # ── Case 1: bring token out of home base (Rule 3) ──
-    if token['pos'] == -1:
-        new_pos = START_IDX[color]
-        # Check if blocked by 2 enemy tokens (Rule 6)
-        if is_blocked(game, player_idx, new_pos):
-            events.append({'type': 'blocked', 'color': color})
-            return events
-        token['pos'] = new_pos
-        token['stretch'] = -1
-        cap = check_capture(game, player_idx, token)
-        if cap:
-            events.append({'type': 'capture', 'by': color, 'victim': cap})
-        return events
-
-    # ── Case 2: move inside home stretch (Rule 7) ──
-    if token['stretch'] >= 0:
-        new_stretch = token['stretch'] + dice
-        if new_stretch == 5:
-            # Reached center exactly
-            token['stretch'] = 5
-            token['finished'] = True
-            player['finished_count'] += 1
-            events.append({'type': 'home', 'color': color})
-            if player['finished_count'] == 4:
-                events.append({'type': 'win', 'color': color})
-        elif new_stretch < 5:
-            token['stretch'] = new_stretch
-        # new_stretch > 5 is prevented by can_move
-        return events
-
-    # ── Case 3: move on outer path ──
-    entry = ENTRY_BEFORE_HOME[color]
-    steps_to_entry = (entry - token['pos']) % 52
+    result = MOVE_RESULT[player.ci][token.pos + 2][token.stretch + 1][dice]
+    if result is None:
+        return events, None   # prevented by can_move
+    new_pos, new_stretch, finished = result
 
-    if dice <= steps_to_entry:
-        # Stays on outer path
-        new_pos = (token['pos'] + dice) % 52
-        # Check blocking (Rule 6)
+    # ── Case 1: leave home base or move on outer path (Rules 3 & 6) ──
+    if new_stretch < 0:
+        # Check if blocked by 2 enemy tokens (Rule 6)
         if is_blocked(game, player_idx, new_pos):
             events.append({'type': 'blocked', 'color': color})
-            return events
-        token['pos'] = new_pos
-        cap = check_capture(game, player_idx, token)
-        if cap:
-            events.append({'type': 'capture', 'by': color, 'victim': cap})
-    else:
-        # Enter home stretch (Rule 7)
-        steps_into_stretch = dice - steps_to_entry - 1
-        token['pos'] = -2   # mark as in home stretch
-        token['stretch'] = steps_into_stretch
-        if token['stretch'] == 5:
-            token['finished'] = True
-            player['finished_count'] += 1
-            events.append({'type': 'home', 'color': color})
-            if player['finished_count'] == 4:
-                events.append({'type': 'win', 'color': color})
-
-    return events
+            return events, None
+        set_token(game, player_idx, token, new_pos, -1)
+        # No capture on safe squares (Rule 4) — this includes every start square
+        if not (SAFE_MASK >> new_pos) & 1:
+            cap = check_capture(game, player_idx, new_pos)
+            if cap:
+                events.append({'type': 'capture', 'by': color, 'victim': cap})
+        return events, None
+
+    # ── Case 2: enter or move inside home stretch (Rule 7) ──
+    set_token(game, player_idx, token, new_pos, new_stretch, finished)
+    if finished:
+        # Reached center exactly
+        player.finished_count += 1
+        events.append({'type': 'home', 'color': color})
+        if player.finished_count == 4:
+            events.append({'type': 'win', 'color': color})
+            return events, color
+
+    return events, None
 
 # ─────────────────────────────────────────────
 # RULE 5: capture
 # ─────────────────────────────────────────────
-def check_capture(game, attacker_idx, token):
-    pos = token['pos']
-    if pos < 0 or token['stretch'] >= 0:
-        return None
-    # No capture on safe squares (Rule 4)
-    if pos in SAFE_SQUARES:
-        return None
-    for i, p in enumerate(game['players']):
-        if i == attacker_idx:
-            continue
-        for t in p['tokens']:
-            if t['pos'] == pos and t['stretch'] < 0 and not t['finished']:
-                # Only capture if NOT a block (single token)
-                count = sum(1 for ot in p['tokens']
-                            if ot['pos'] == pos and ot['stretch'] < 0 and not ot['finished'])
-                if count == 1:
-                    t['pos'] = -1
-                    t['stretch'] = -1
-                    return p['color']
+def check_capture(game, attacker_idx, pos):
+    """Sends a lone enemy token on outer-path square pos home; pos must not be safe."""
+    for i, toks in tokens_at(game, pos, attacker_idx).items():
+        # Only capture if NOT a block (single token)
+        if len(toks) == 1:
+            set_token(game, i, toks[0], -1, -1)
+            return game['players'][i].color
     return None
 
 # ─────────────────────────────────────────────
@@ -201,311 +327,685 @@ def check_capture(game, attacker_idx, token):
 # ─────────────────────────────────────────────
 def check_triple_six(game, player_idx):
     """Returns True if this player just rolled their 3rd consecutive 6."""
-    history = game.get('six_streak', {})
-    streak  = history.get(player_idx, 0)
-    if game['dice_value'] == 6:
-        history[player_idx] = streak + 1
-    else:
-        history[player_idx] = 0
-    game['six_streak'] = history
-    return history.get(player_idx, 0) >= 3
+    streak = game['six_streak']
+    streak[player_idx] = streak[player_idx] + 1 if game['dice_value'] == 6 else 0
+    return streak[player_idx] >= 3
+
+# ─────────────────────────────────────────────
+# DICE — each room draws from a prefilled pool of rolls
+# ─────────────────────────────────────────────
+DICE_POOL_SIZE = 256
+
+# os.urandom byte -> face; bytes 252..255 are dropped so every face keeps exactly 42/252
+_DIE_FACE   = bytes(b % 6 + 1 for b in range(256))
+_DIE_REJECT = bytes(range(252, 256))
+
+def roll_die(game):
+    pool = game['_dice_pool']
+    while not pool:
+        pool.extend(os.urandom(DICE_POOL_SIZE).translate(_DIE_FACE, _DIE_REJECT))
+    return pool.popleft()
 
 # ─────────────────────────────────────────────
 # CPU AI
 # ─────────────────────────────────────────────
-def cpu_choose_token(game, player_idx):
-    player  = game['players'][player_idx]
-    color   = player['color']
-    dice    = game['dice_value']
-    movable = [t for t in player['tokens']
-               if can_move(t, dice, color) and not _would_block(game, player_idx, t, dice)]
-    if not movable:
-        # try including blocked moves
-        movable = [t for t in player['tokens'] if can_move(t, dice, color)]
-    if not movable:
+MoveInfo = namedtuple('MoveInfo', 'token new_pos blocked captures progress')
+
+def _evaluate(game, player_idx, token, dice):
+    """Returns a MoveInfo for moving token by dice, or None if it cannot move."""
+    if token.finished:
         return None
+    ci     = game['players'][player_idx].ci
+    result = MOVE_RESULT[ci][token.pos + 2][token.stretch + 1][dice]
+    if result is None:
+        return None
+    new_pos, new_stretch, _ = result
 
-    # Priority 1: capture an enemy
-    for t in movable:
-        if t['pos'] >= 0 and t['stretch'] < 0:
-            entry = ENTRY_BEFORE_HOME[color]
-            steps = (entry - t['pos']) % 52
-            if dice <= steps:
-                new_pos = (t['pos'] + dice) % 52
-                if new_pos not in SAFE_SQUARES:
-                    for p2 in game['players']:
-                        if p2['color'] == color: continue
-                        enemies = [ot for ot in p2['tokens']
-                                   if ot['pos'] == new_pos and ot['stretch'] < 0 and not ot['finished']]
-                        if len(enemies) == 1:
-                            return t['id']
-
-    # Priority 2: bring token out on 6
-    if dice == 6:
-        for t in movable:
-            if t['pos'] == -1:
-                return t['id']
-
-    # Priority 3: advance furthest token
-    on_board = [t for t in movable if t['pos'] >= 0 or t['stretch'] >= 0]
-    if on_board:
-        def progress(t):
-            if t['stretch'] >= 0: return 1000 + t['stretch']
-            return (t['pos'] - START_IDX[color]) % 52
-        return max(on_board, key=progress)['id']
-
-    return movable[0]['id']
-
-def _would_block(game, player_idx, token, dice):
-    """Check if the move result would be blocked by enemies."""
-    color = game['players'][player_idx]['color']
-    if token['pos'] == -1:
-        new_pos = START_IDX[color]
-        return is_blocked(game, player_idx, new_pos)
-    if token['stretch'] >= 0:
-        return False
-    entry = ENTRY_BEFORE_HOME[color]
-    steps = (entry - token['pos']) % 52
-    if dice <= steps:
-        new_pos = (token['pos'] + dice) % 52
-        return is_blocked(game, player_idx, new_pos)
-    return False
+    blocked = captures = False
+    if new_stretch < 0:
+        enemies = tokens_at(game, new_pos, player_idx)
+        blocked = any(len(toks) >= 2 for toks in enemies.values())
+        if token.pos >= 0 and not (SAFE_MASK >> new_pos) & 1:
+            captures = any(len(toks) == 1 for toks in enemies.values())
+
+    progress = PROGRESS[ci][token.pos + 2][token.stretch + 1]
+    return MoveInfo(token, new_pos, blocked, captures, progress)
+
+def cpu_choose_token(game, player_idx):
+    dice = game['dice_value']
+    mask = game['movable']
+    best = {False: None, True: None}   # blocked? -> (rank, token id) of the best move so far
+    for i, t in enumerate(game['players'][player_idx].tokens):
+        if not (mask >> i) & 1:
+            continue
+        m = _evaluate(game, player_idx, t, dice)
+        # Priority 1: capture an enemy (an unblocked one is taken on the spot)
+        # Priority 2: bring token out on 6
+        # Priority 3: advance furthest token; -i keeps the earliest token on ties
+        if m.captures:
+            if not m.blocked:
+                return i
+            rank = (3, -i)
+        elif m.progress is None:
+            rank = (2 if dice == 6 else 0, -i)
+        else:
+            rank = (1, m.progress, -i)
+        if best[m.blocked] is None or rank > best[m.blocked][0]:
+            best[m.blocked] = (rank, i)
+
+    # Prefer moves that aren't blocked; fall back to blocked ones
+    pick = best[False] or best[True]
+    return pick[1] if pick else None
+
+# ─────────────────────────────────────────────
+# CPU LOOKAHEAD — used by 'hard' CPUs
+# A position is 16 bytes, one per token, player-major: 0 at home base,
+# 1 + pos on the outer path, 53 + stretch in the home stretch (58 == finished).
+# Seat i always plays COLORS[i], so a player index doubles as its color index.
+# ─────────────────────────────────────────────
+CPU_LEVELS    = ('easy', 'hard')
+SEARCH_DEPTH  = 2      # plies: our move, then the next roller's reply
+SEARCH_CACHE  = 50000  # positions kept in the transposition table
+THREAT_WEIGHT = 8      # score lost per own token an enemy could hit next roll
+OUT_BONUS     = 12     # worth of getting a token off its home base
+FINISH_BONUS  = 10     # worth of getting a token to the center, on top of its steps
+SAFE_BONUS    = 6      # worth of standing where no one can hit you: safe squares, the stretch
+HOME_CELL, FINISHED_CELL = 0, 58
+
+# Steps a color has walked on reaching stretch 0: one past its entry square, which is
+# relative step 50 for most colors but 51 for red
+STRETCH_BASE = tuple((ENTRY_BEFORE_HOME[ci] - START_IDX[ci]) % 52 + 1 for ci in range(len(COLORS)))
+TOKEN_MAX    = OUT_BONUS + max(STRETCH_BASE) + 5 + FINISH_BONUS
+
+def _cell(pos, stretch):
+    return 53 + stretch if stretch >= 0 else pos + 1
+
+def _cell_step(cell, dice, ci):
+    if cell == FINISHED_CELL:
+        return -1
+    pos, stretch = (-2, cell - 53) if cell >= 53 else (cell - 1, -1)
+    result = MOVE_RESULT[ci][pos + 2][stretch + 1][dice]
+    return -1 if result is None else _cell(result[0], result[1])
+
+def _cell_value(cell, ci):
+    if cell == HOME_CELL:
+        return 0
+    if cell >= 53:
+        steps = STRETCH_BASE[ci] + cell - 53 + (SAFE_BONUS if cell != FINISHED_CELL else 0)
+    else:
+        pos   = cell - 1
+        steps = (pos - START_IDX[ci]) % 52 + ((SAFE_MASK >> pos) & 1) * SAFE_BONUS
+    return OUT_BONUS + steps + (FINISH_BONUS if cell == FINISHED_CELL else 0)
+
+# STEP[ci][cell][dice] -> cell after the move, -1 if illegal; VALUE[ci][cell] -> progress score
+STEP  = tuple(tuple(tuple(_cell_step(c, d, ci) if d > 0 else -1 for d in range(7))
+                    for c in range(59)) for ci in range(len(COLORS)))
+VALUE = tuple(tuple(_cell_value(c, ci) for c in range(59)) for ci in range(len(COLORS)))
+EVAL_MIN = -4 * TOKEN_MAX - 4 * THREAT_WEIGHT
+EVAL_MAX = 4 * TOKEN_MAX
+
+_search_cache = OrderedDict()   # (cells, mover, depth, me) -> (value, bound); bound 0 exact, 1 lower, -1 upper
+
+def _pack(game):
+    return bytes(FINISHED_CELL if t.finished else _cell(t.pos, t.stretch)
+                 for p in game['players'] for t in p.tokens)
+
+def _sim_move(cells, pidx, tidx, dice):
+    """Returns cells after the move (unchanged when blocked), or None if it is illegal."""
+    slot = pidx * 4 + tidx
+    new  = STEP[pidx][cells[slot]][dice]
+    if new < 0:
+        return None
+    out = bytearray(cells)
+    out[slot] = new
+    if 1 <= new <= 52:
+        enemies = [o * 4 for o in range(4) if o != pidx]
+        if any(cells[o:o + 4].count(new) >= 2 for o in enemies):
+            return cells
+        if not (SAFE_MASK >> (new - 1)) & 1:
+            for o in enemies:
+                if cells[o:o + 4].count(new) == 1:
+                    out[cells.index(new, o, o + 4)] = HOME_CELL
+                    break
+    return bytes(out)
+
+def _sim_eval(cells, me):
+    """Own progress, less a penalty per exposed token, less the opponents' mean progress."""
+    mine = others = 0
+    for p in range(4):
+        value = VALUE[p]
+        total = sum(value[c] for c in cells[p * 4:p * 4 + 4])
+        if p == me:
+            mine = total
+        else:
+            others += total
+
+    threats = 0
+    for c in cells[me * 4:me * 4 + 4]:
+        if 1 <= c <= 52 and not (SAFE_MASK >> (c - 1)) & 1:
+            if any(1 <= e <= 52 and 1 <= (c - e) % 52 <= 6
+                   for o in range(4) if o != me for e in cells[o * 4:o * 4 + 4]):
+                threats += 1
+    return mine - THREAT_WEIGHT * threats - others / 3
+
+def _search_chance(cells, mover, depth, me, a, b):
+    """Expected score over mover's next roll, with Star1 cutoffs against the (a, b) window."""
+    if depth == 0:
+        return _sim_eval(cells, me)
+    key = (cells, mover, depth, me)
+    hit = _search_cache.get(key)
+    if hit is not None:
+        _search_cache.move_to_end(key)
+        v, bound = hit
+        if bound == 0 or (bound > 0 and v >= b) or (bound < 0 and v <= a):
+            return v
+
+    total = 0.0
+    v = bound = None
+    for dice in range(1, 7):
+        rest = 6 - dice
+        ca = max(6 * a - total - rest * EVAL_MAX, EVAL_MIN)
+        cb = min(6 * b - total - rest * EVAL_MIN, EVAL_MAX)
+        total += _search_decide(cells, mover, dice, depth, me, ca, cb)
+        if (total + rest * EVAL_MAX) / 6 <= a:
+            v, bound = (total + rest * EVAL_MAX) / 6, -1
+            break
+        if (total + rest * EVAL_MIN) / 6 >= b:
+            v, bound = (total + rest * EVAL_MIN) / 6, 1
+            break
+    else:
+        v = total / 6
+        bound = 0 if a < v < b else (1 if v >= b else -1)
+
+    _search_cache[key] = (v, bound)
+    if len(_search_cache) > SEARCH_CACHE:
+        _search_cache.popitem(last=False)
+    return v
+
+def _search_decide(cells, mover, dice, depth, me, a, b):
+    """Best reply for mover with this dice: max for me, min for everyone else."""
+    nxt = mover if dice == 6 else (mover + 1) % 4
+    children = dict.fromkeys(c for c in (_sim_move(cells, mover, t, dice) for t in range(4))
+                             if c is not None)
+    if not children:
+        return _search_chance(cells, nxt, depth - 1, me, a, b)
+
+    if mover == me:
+        best = EVAL_MIN
+        for child in children:
+            best = max(best, _search_chance(child, nxt, depth - 1, me, a, b))
+            a = max(a, best)
+            if a >= b:
+                break
+    else:
+        best = EVAL_MAX
+        for child in children:
+            best = min(best, _search_chance(child, nxt, depth - 1, me, a, b))
+            b = min(b, best)
+            if a >= b:
+                break
+    return best
+
+def cpu_search_token(game, player_idx):
+    """Picks a token by looking SEARCH_DEPTH plies ahead; falls back to the heuristic."""
+    mask = game['movable']
+    if not mask & (mask - 1):
+        return cpu_choose_token(game, player_idx)   # zero or one legal move: nothing to search
+
+    cells = _pack(game)
+    dice  = game['dice_value']
+    nxt   = player_idx if dice == 6 else (player_idx + 1) % 4
+    best, best_v = None, EVAL_MIN - 1
+    for i in range(4):
+        if not (mask >> i) & 1:
+            continue
+        child = _sim_move(cells, player_idx, i, dice)
+        v = _search_chance(child, nxt, SEARCH_DEPTH - 1, player_idx, best_v, EVAL_MAX + 1)
+        if v > best_v:
+            best, best_v = i, v
+    return best
 
 # ─────────────────────────────────────────────
 # ROOM MANAGEMENT
 # ─────────────────────────────────────────────
 rooms    = {}
 players  = {}
-mm_queue = []
-
-def create_room(mode):
-    room_id   = str(uuid.uuid4())[:8].upper()
-    cpu_flags = {
-        '4p':  [False, False, False, False],
-        '1v3': [False, True,  True,  True ],
-        '2v2': [False, False, True,  True ],
-        '3v1': [False, False, False, True ],
-    }.get(mode, [False]*4)
+mm_queue = OrderedDict()   # waiting sid -> None, in arrival order
+MM_ROOM  = 'mm'      # Socket.IO room of everyone waiting, for one-shot count updates
+
+FINISHED_ROOM_TTL = 60    # seconds a finished game is kept for the win screen
+IDLE_ROOM_TTL     = 600   # seconds a lobby may wait for players before it is dropped
+
+# Room codes are the only thing keeping a private room private, so they come from
+# the OS CSPRNG: 40 random bits, retried on the rare clash with a live room.
+def new_room_id():
+    while True:
+        room_id = base64.b32encode(secrets.token_bytes(5)).decode()   # 8 chars, no padding
+        if room_id not in rooms:
+            return room_id
+
+ROOM_ID_RE = re.compile(r'[A-Z2-7]{8}')   # anything else cannot be a room code
+
+MODE_CPU = {
+    '4p':  (False, False, False, False),
+    '1v3': (False, True,  True,  True ),
+    '2v2': (False, False, True,  True ),
+    '3v1': (False, False, False, True ),
+}
+# Seat sets are 4-bit masks, bit i for seat i
+MODE_HUMANS = {mode: sum(1 << i for i, c in enumerate(flags) if not c) for mode, flags in MODE_CPU.items()}
+
+def lowest_seat(mask):
+    return (mask & -mask).bit_length() - 1
+
+def _start_hash():
+    h = 0
+    for i, p in enumerate(Player(c, False) for c in COLORS):
+        for t in p.tokens:
+            h ^= token_hash(i, t)
+    return h
+
+# Every room starts with all 16 tokens at home, so it always starts from this hash
+START_HASH = _start_hash()
+
+def create_room(mode, cpu_level='easy'):
+    room_id   = new_room_id()
+    if mode not in MODE_CPU:
+        mode = '4p'
+    if cpu_level not in CPU_LEVELS:
+        cpu_level = 'easy'
+    cpu_flags = MODE_CPU[mode]
+    seats     = [Player(COLORS[i], cpu_flags[i]) for i in range(4)]
 
     game = {
         'room_id':        room_id,
         'mode':           mode,
-        'players':        [make_player(COLORS[i], cpu_flags[i]) for i in range(4)],
+        'cpu_level':      cpu_level,
+        'players':        seats,
         'current_player': 0,
         'dice_value':     0,
         'rolled':         False,
         'game_over':      False,
         'winner':         None,
-        'human_slots':    [i for i, c in enumerate(cpu_flags) if not c],
-        'filled_slots':   [],
+        'human_mask':     MODE_HUMANS[mode],
+        'filled_mask':    0,
         'started':        False,
-        'six_streak':     {},
+        'six_streak':     [0, 0, 0, 0],
         'extra_turn':     False,
+        'movable':        0,      # movable_mask() for the current roll
+        '_state_hash':    START_HASH,
+        '_occupancy':     {},     # pos -> {player_idx: [token, ...]}, kept by set_token
+        '_last_sig':      None,
+        '_full_sig':      None,   # lobby/seat state the clients last got a snapshot of
+        '_sent':          {},     # DELTA_FIELDS as of the last emit
+        '_dirty':         set(),  # (player_idx, token_idx) moved since the last emit
+        '_version':       0,      # bumped on every game_state/game_delta emit
+        '_lock':          threading.RLock(),   # held by whatever is changing this room
+        '_pending_emit':  [],     # notifications riding on the next broadcast
+        '_dice_pool':     deque(),
     }
     rooms[room_id] = game
+    schedule(IDLE_ROOM_TTL, room_id, 'expire')
     return room_id
 
+def room_lock(room_id):
+    """The lock serializing changes to a room; a no-op context if the room is gone."""
+    game = rooms.get(room_id)
+    return game['_lock'] if game else nullcontext()
+
+def evict_room(room_id):
+    """Drops a room and the seat records pointing at it; its pending timers then lapse."""
+    game = rooms.pop(room_id, None)
+    if not game:
+        return
+    for p in game['players']:
+        info = players.get(p.sid)
+        if info and info['room_id'] == room_id:
+            del players[p.sid]
+    socketio.close_room(room_id)
+
+def end_game(room_id, winner, events):
+    game = rooms[room_id]
+    game['game_over'] = True
+    game['winner']    = winner
+    broadcast(room_id, events)
+    schedule(FINISHED_ROOM_TTL, room_id, 'evict')
+
 def game_to_client(game, events=None):
+    # Seat i is always COLORS[i], so colors travel as seat indices and players
+    # as their CPU flag plus [pos, stretch, finished] rows; sids stay server-side
     payload = {
         'room_id':        game['room_id'],
         'mode':           game['mode'],
-        'players':        game['players'],
+        'cpu':            [p.is_cpu for p in game['players']],
+        'tokens':         [[[t.pos, t.stretch, int(t.finished)] for t in p.tokens]
+                           for p in game['players']],
         'current_player': game['current_player'],
         'dice_value':     game['dice_value'],
         'rolled':         game['rolled'],
         'game_over':      game['game_over'],
-        'winner':         game['winner'],
+        'winner':         COLOR_IDX.get(game['winner']),
         'started':        game['started'],
-        'human_slots':    game['human_slots'],
-        'filled_slots':   game['filled_slots'],
+        'human_mask':     game['human_mask'],
+        'filled_mask':    game['filled_mask'],
         'extra_turn':     game.get('extra_turn', False),
     }
     if events:
         payload['events'] = events
+    payload['v'] = game['_version']
     return payload
 
+# Turn fields a mid-game 'game_delta' carries when they change
+DELTA_FIELDS = ('current_player', 'dice_value', 'rolled', 'extra_turn')
+
 def broadcast(room_id, events=None):
     game = rooms.get(room_id)
-    if game:
-        socketio.emit('game_state', game_to_client(game, events), room=room_id)
+    if not game:
+        return
+    # Skip the emit when nothing the client renders has changed since the last one
+    full_sig = (game['started'], game['game_over'], game['filled_mask'],
+                tuple(p.is_cpu for p in game['players']))
+    sig = (game['_state_hash'], game['current_player'], game['dice_value'],
+           game['rolled'], game['extra_turn'], full_sig)
+    pending = game['_pending_emit']
+    if sig == game['_last_sig'] and not events and not pending:
+        return
+    game['_last_sig'] = sig
+
+    # Mid-game, clients already hold a snapshot: send only what moved.
+    # Joins, seat changes, the start and the end still get the full state.
+    if game['started'] and not game['game_over'] and full_sig == game['_full_sig']:
+        sent    = game['_sent']
+        changes = {f: game[f] for f in DELTA_FIELDS if game[f] != sent.get(f)}
+        sent.update(changes)
+        if game['_dirty']:
+            moved = []
+            for pi, ti in sorted(game['_dirty']):
+                t = game['players'][pi].tokens[ti]
+                moved.append([pi, ti, t.pos, t.stretch, int(t.finished)])
+            changes['tokens'] = moved
+            game['_dirty'].clear()
+        broadcast_delta(room_id, changes, events)
+        return
+
+    game['_full_sig'] = full_sig
+    game['_sent']     = {f: game[f] for f in DELTA_FIELDS}
+    game['_dirty'].clear()
+    game['_version'] += 1
+    payload = game_to_client(game, events)
+    if pending:
+        payload['notifications'] = pending
+        game['_pending_emit'] = []
+    socketio.emit('game_state', payload, room=room_id)
+
+def broadcast_delta(room_id, changes, events=None):
+    """Emits only the changed turn fields and tokens; the client patches its snapshot."""
+    game = rooms[room_id]
+    game['_version'] += 1
+    changes['v'] = game['_version']
+    if events:
+        changes['events'] = events
+    if game['_pending_emit']:
+        changes['notifications'] = game['_pending_emit']
+        game['_pending_emit'] = []
+    socketio.emit('game_delta', changes, room=room_id)
+
+def notify(game, msg):
+    """Queues a toast for the room; it is delivered with the next broadcast."""
+    game['_pending_emit'].append(msg)
 
 # ─────────────────────────────────────────────
 # TURN MANAGEMENT
 # ─────────────────────────────────────────────
-def next_turn(room_id, rolled_six=False):
+def next_turn(room_id, rolled_six=False, events=None, hold=0.0):
+    """Hands the turn on (or back, after a 6) and broadcasts it together with events.
+
+    hold is how long the clients spend playing events back; a CPU's next roll waits for it.
+    """
     game = rooms.get(room_id)
     if not game or game['game_over']:
         return
-    game['rolled'] = False
+    game['rolled']  = False
+    game['movable'] = 0
 
     # Rule 8: triple six → lose turn, send last moved token back
     if check_triple_six(game, game['current_player']):
         cp = game['players'][game['current_player']]
         # Send the last moved token back (if any)
-        last_idx = cp.get('last_moved_token')
+        last_idx = cp.last_moved_token
         if last_idx is not None:
-            last_token = cp['tokens'][last_idx]
-            if last_token['pos'] >= 0 or last_token['stretch'] >= 0:
-                last_token['pos'] = -1
-                last_token['stretch'] = -1
+            last_token = cp.tokens[last_idx]
+            if last_token.pos >= 0 or last_token.stretch >= 0:
+                set_token(game, game['current_player'], last_token, -1, -1)
                 # If the token was in home stretch and not finished, it's now back at start
-        socketio.emit('notification',
-            {'msg': f"3 sixes in a row! {cp['color'].upper()} loses their turn!"},
-            room=room_id)
+        notify(game, f"3 sixes in a row! {cp.color.upper()} loses their turn!")
         game['six_streak'][game['current_player']] = 0
         rolled_six = False  # force advance (no extra turn despite rolling six)
 
     # Rule 8: rolled 6 → extra turn (same player)
     if rolled_six:
         game['extra_turn'] = True
-        broadcast(room_id)
         cp = game['players'][game['current_player']]
-        socketio.emit('notification',
-            {'msg': f"🎲 {cp['color'].upper()} rolled 6 — EXTRA TURN!"},
-            room=room_id)
-        if cp['is_cpu']:
-            start_cpu_turn(room_id, delay=1.0)
+        notify(game, f"🎲 {cp.color.upper()} rolled 6 — EXTRA TURN!")
+        broadcast(room_id, events)
+        if cp.is_cpu:
+            start_cpu_turn(room_id, delay=1.0 + hold)
         return
 
     # Advance to next player
     game['extra_turn'] = False
     game['current_player'] = (game['current_player'] + 1) % 4
-    broadcast(room_id)
+    broadcast(room_id, events)
     cp = game['players'][game['current_player']]
-    if cp['is_cpu']:
-        start_cpu_turn(room_id)
+    if cp.is_cpu:
+        start_cpu_turn(room_id, delay=1.2 + hold)
+
+CPU_MOVE_DELAY = 0.7   # seconds a CPU's roll is on show before its move plays
 
 def start_cpu_turn(room_id, delay=1.2):
-    def run():
-        time.sleep(delay)
-        game = rooms.get(room_id)
-        if not game or game['game_over'] or game['rolled']:
-            return
-        cp = game['players'][game['current_player']]
-        if not cp['is_cpu']:
-            return
+    schedule(delay, room_id, 'roll')
 
-        # Roll
-        val = random.randint(1, 6)
-        game['dice_value'] = val
-        game['rolled']     = True
-        broadcast(room_id)
+def _cpu_roll(room_id):
+    game = rooms.get(room_id)
+    if not game or game['game_over'] or game['rolled']:
+        return
+    cp = game['players'][game['current_player']]
+    if not cp.is_cpu:
+        return
 
-        color   = cp['color']
-        movable = [t for t in cp['tokens'] if can_move(t, val, color)]
-
-        if not movable:
-            # Even if no moves, a 6 still grants an extra turn
-            socketio.emit('notification',
-                {'msg': f"{color.upper()} rolled {val} — no moves!"},
-                room=room_id)
-            time.sleep(1.0)
-            next_turn(room_id, rolled_six=(val == 6))
-            return
-
-        time.sleep(0.7)
-        tok_id = cpu_choose_token(game, game['current_player'])
-        if tok_id is None:
-            socketio.emit('notification',
-                {'msg': f"{color.upper()} has no valid moves!"},
-                room=room_id)
-            time.sleep(0.8)
-            next_turn(room_id, rolled_six=(val == 6))
-            return
-
-        events = apply_move(game, game['current_player'], tok_id)
-        win    = next((e for e in events if e['type'] == 'win'), None)
-        if win:
-            game['game_over'] = True
-            game['winner']    = win['color']
-            broadcast(room_id, events)
-            return
+    val = roll_die(game)
+    game['dice_value'] = val
+    game['rolled']     = True
+    game['movable']    = movable_mask(cp, val)
 
-        broadcast(room_id, events)
-        time.sleep(0.5)
+    if not game['movable']:
+        # Even if no moves, a 6 still grants an extra turn; the roll and the pass go out together
+        notify(game, f"{cp.color.upper()} rolled {val} — no moves!")
         next_turn(room_id, rolled_six=(val == 6))
+        return
+
+    # Roll, move and turn change share one emit; the cpu_roll event tells the
+    # clients to show the dice for CPU_MOVE_DELAY before playing the move
+    choose = cpu_search_token if game['cpu_level'] == 'hard' else cpu_choose_token
+    tok_id = choose(game, game['current_player'])
+    events, winner = apply_move(game, game['current_player'], tok_id)
+    events.insert(0, {'type': 'cpu_roll', 'val': val, 'delay': int(CPU_MOVE_DELAY * 1000)})
+    if winner:
+        end_game(room_id, winner, events)
+        return
+    next_turn(room_id, rolled_six=(val == 6), events=events, hold=CPU_MOVE_DELAY)
 
-    threading.Thread(target=run, daemon=True).start()
+def _pass_turn(room_id):
+    """Ends a human turn whose roll had no legal move, once the roll has been seen."""
+    game = rooms.get(room_id)
+    if not game or game['game_over'] or not game['rolled'] or game['movable']:
+        return
+    if game['players'][game['current_player']].is_cpu:
+        return   # seat went to the CPU meanwhile; it runs its own turn
+    next_turn(room_id, rolled_six=(game['dice_value'] == 6))
+
+def _expire_lobby(room_id):
+    game = rooms.get(room_id)
+    if game and not game['started']:
+        # Whoever is still waiting in the lobby is sent back to the menu
+        socketio.emit('error', {'msg': 'Room expired — nobody joined in time.', 'closed': True},
+                      room=room_id)
+        evict_room(room_id)
+
+# ─────────────────────────────────────────────
+# TURN SCHEDULER — one background task drives every pending turn step and room expiry
+# ─────────────────────────────────────────────
+PHASES = {'roll': _cpu_roll, 'pass': _pass_turn,
+          'expire': _expire_lobby, 'evict': evict_room}
+
+_timers       = []                  # heap of (when, seq, room_id, phase)
+_timer_seq    = itertools.count()
+_timer_wake   = threading.Event()   # green under eventlet.monkey_patch()
+_timer_thread = None
+
+def schedule(delay, room_id, phase):
+    global _timer_thread
+    heapq.heappush(_timers, (time.monotonic() + delay, next(_timer_seq), room_id, phase))
+    if _timer_thread is None:
+        _timer_thread = socketio.start_background_task(_run_scheduler)
+    _timer_wake.set()
+
+def _run_scheduler():
+    while True:
+        _timer_wake.clear()
+        now = time.monotonic()
+        while _timers and _timers[0][0] <= now:
+            _, _, room_id, phase = heapq.heappop(_timers)
+            try:
+                with room_lock(room_id):
+                    PHASES[phase](room_id)
+            except Exception:
+                traceback.print_exc()
+        timeout = _timers[0][0] - time.monotonic() if _timers else None
+        _timer_wake.wait(timeout)
 
 # ─────────────────────────────────────────────
 # SOCKET EVENTS
 # ─────────────────────────────────────────────
 
+# Token bucket per sid for gameplay events: bursts of RATE_BURST, refilled at RATE_REFILL/s
+RATE_BURST  = 5.0
+RATE_REFILL = 5.0
+_rate       = {}   # sid -> (last_seen, tokens)
+
+# 'sync' has its own limit so a burst of rolls and moves can never swallow a resync
+SYNC_GAP    = 1.0  # seconds between snapshots sent to one client
+_last_sync  = {}   # sid -> when it was last sent a snapshot
+
+def rate_ok(sid):
+    """Returns False when this client is sending game events faster than allowed."""
+    now = time.monotonic()
+    last, tokens = _rate.get(sid, (now, RATE_BURST))
+    tokens = min(RATE_BURST, tokens + (now - last) * RATE_REFILL)
+    if tokens < 1:
+        _rate[sid] = (now, tokens)
+        return False
+    _rate[sid] = (now, tokens - 1)
+    return True
+
+def locks_room(handler):
+    """Runs a socket handler under the lock of the room its client is seated in."""
+    @functools.wraps(handler)
+    def wrapper(*args):
+        info = players.get(request.sid)
+        with room_lock(info['room_id'] if info else None):
+            return handler(*args)
+    return wrapper
+
 @socketio.on('connect')
 def on_connect():
     print(f"[+] {request.sid}")
 
 @socketio.on('disconnect')
+@locks_room
 def on_disconnect():
     sid = request.sid
-    if sid in mm_queue:
-        mm_queue.remove(sid)
+    mm_queue.pop(sid, None)
+    _rate.pop(sid, None)
+    _last_sync.pop(sid, None)
     info = players.pop(sid, None)
     if info:
         game = rooms.get(info['room_id'])
         if game:
             pidx = info['player_idx']
-            game['players'][pidx]['sid']    = None
-            game['players'][pidx]['is_cpu'] = True
+            game['players'][pidx].sid    = None
+            game['players'][pidx].is_cpu = True
             # If it was this player's turn and game is active, start CPU turn
-            if game['started'] and not game['game_over'] and game['current_player'] == pidx:
-                # If they had already rolled, reset rolled flag so CPU can roll anew
-                game['rolled'] = False
-                start_cpu_turn(info['room_id'], delay=1.0)
-            broadcast(info['room_id'])
+            if not any(p.sid for p in game['players']):
+                # Last human gone: nobody is left to watch, so free the room now
+                evict_room(info['room_id'])
+            else:
+                if game['started'] and not game['game_over'] and game['current_player'] == pidx:
+                    # If they had already rolled, reset rolled flag so CPU can roll anew
+                    game['rolled'] = False
+                    start_cpu_turn(info['room_id'], delay=1.0)
+                broadcast(info['room_id'])
     print(f"[-] {sid}")
 
 @socketio.on('create_room')
 def on_create_room(data):
     mode    = data.get('mode', '1v3')
-    room_id = create_room(mode)
+    room_id = create_room(mode, data.get('cpu', 'easy'))
     game    = rooms[room_id]
-    slot    = game['human_slots'][0]
+    slot    = lowest_seat(game['human_mask'])
 
-    game['players'][slot]['sid'] = request.sid
-    game['filled_slots'].append(slot)
+    game['players'][slot].sid = request.sid
+    game['filled_mask'] |= 1 << slot
     players[request.sid] = {'room_id': room_id, 'player_idx': slot}
     join_room(room_id)
     emit('joined', {'room_id': room_id, 'player_idx': slot, 'color': COLORS[slot]})
 
-    if len(game['human_slots']) == 1:
+    if game['filled_mask'] == game['human_mask']:
         game['started'] = True
         broadcast(room_id)
         cp = game['players'][game['current_player']]
-        if cp['is_cpu']:
+        if cp.is_cpu:
             start_cpu_turn(room_id)
     else:
         broadcast(room_id)
 
 @socketio.on('join_room')
 def on_join_room(data):
-    room_id = data.get('room_id', '').upper().strip()
-    game    = rooms.get(room_id)
-    if not game:
+    room_id = data.get('room_id')
+    if type(room_id) is str:
+        room_id = room_id.strip().upper()   # accept pasted or lower-case codes
+    # Reject junk before any lookup
+    if type(room_id) is not str or not ROOM_ID_RE.fullmatch(room_id):
         emit('error', {'msg': 'Room not found!'}); return
-    if game['started']:
-        emit('error', {'msg': 'Game already started!'}); return
-    open_slots = [s for s in game['human_slots'] if s not in game['filled_slots']]
-    if not open_slots:
-        emit('error', {'msg': 'Room is full!'}); return
-
-    slot = open_slots[0]
-    game['players'][slot]['sid'] = request.sid
-    game['filled_slots'].append(slot)
-    players[request.sid] = {'room_id': room_id, 'player_idx': slot}
-    join_room(room_id)
-    emit('joined', {'room_id': room_id, 'player_idx': slot, 'color': COLORS[slot]})
-
-    if set(game['human_slots']) == set(game['filled_slots']):
-        game['started'] = True
-    broadcast(room_id)
-    if game['started']:
-        cp = game['players'][game['current_player']]
-        if cp['is_cpu']:
-            start_cpu_turn(room_id)
+    with room_lock(room_id):
+        game = rooms.get(room_id)
+        if not game:
+            emit('error', {'msg': 'Room not found!'}); return
+        if game['started']:
+            emit('error', {'msg': 'Game already started!'}); return
+        open_slots = game['human_mask'] & ~game['filled_mask']
+        if not open_slots:
+            emit('error', {'msg': 'Room is full!'}); return
+
+        slot = lowest_seat(open_slots)
+        game['players'][slot].sid = request.sid
+        game['filled_mask'] |= 1 << slot
+        players[request.sid] = {'room_id': room_id, 'player_idx': slot}
+        join_room(room_id)
+        emit('joined', {'room_id': room_id, 'player_idx': slot, 'color': COLORS[slot]})
+
+        if game['filled_mask'] == game['human_mask']:
+            game['started'] = True
+        broadcast(room_id)
+        if game['started']:
+            cp = game['players'][game['current_player']]
+            if cp.is_cpu:
+                start_cpu_turn(room_id)
 
 @socketio.on('roll_dice')
+@locks_room
 def on_roll_dice(data):
+    if not rate_ok(request.sid): return
     info = players.get(request.sid)
     if not info: return
     game = rooms.get(info['room_id'])
@@ -514,25 +1014,23 @@ def on_roll_dice(data):
     if game['current_player'] != pidx:
         emit('error', {'msg': "Not your turn!"}); return
 
-    val   = random.randint(1, 6)
+    val   = roll_die(game)
     game['dice_value'] = val
     game['rolled']     = True
+    game['movable']    = movable_mask(game['players'][pidx], val)
 
-    cp      = game['players'][pidx]
-    color   = cp['color']
-    movable = [t for t in cp['tokens'] if can_move(t, val, color)]
-
+    # Rule 9: if no moves, still grant extra turn if rolled a 6
+    if not game['movable']:
+        notify(game, f"Rolled {val} — need a 6 to move!" if val != 6 else "Rolled 6 but all blocked!")
     broadcast(info['room_id'])
 
-    # Rule 9: if no moves, still grant extra turn if rolled a 6
-    if not movable:
-        msg = f"Rolled {val} — need a 6 to move!" if val != 6 else f"Rolled 6 but all blocked!"
-        socketio.emit('notification', {'msg': msg}, room=info['room_id'])
-        time.sleep(0.6)
-        next_turn(info['room_id'], rolled_six=(val == 6))
+    if not game['movable']:
+        schedule(0.6, info['room_id'], 'pass')
 
 @socketio.on('move_token')
+@locks_room
 def on_move_token(data):
+    if not rate_ok(request.sid): return
     info = players.get(request.sid)
     if not info: return
     game     = rooms.get(info['room_id'])
@@ -540,45 +1038,50 @@ def on_move_token(data):
     token_id = data.get('token_id')
     if not game or game['game_over'] or not game['rolled']: return
     if game['current_player'] != pidx: return
-    if token_id is None or not (0 <= token_id <= 3): return
+    if type(token_id) is not int or token_id & ~3: return   # one test for 0..3
 
-    cp    = game['players'][pidx]
-    token = cp['tokens'][token_id]
-    if not can_move(token, game['dice_value'], cp['color']):
+    if not (game['movable'] >> token_id) & 1:
         emit('error', {'msg': 'Cannot move that token!'}); return
 
-    events   = apply_move(game, pidx, token_id)
-    dice_val = game['dice_value']
+    events, winner = apply_move(game, pidx, token_id)
+    dice_val       = game['dice_value']
 
-    win = next((e for e in events if e['type'] == 'win'), None)
-    if win:
-        game['game_over'] = True
-        game['winner']    = win['color']
-        broadcast(info['room_id'], events)
+    if winner:
+        end_game(info['room_id'], winner, events)
         return
 
-    broadcast(info['room_id'], events)
+    # Rule 8: rolled 6 → extra turn; the move rides on the turn-change broadcast
+    next_turn(info['room_id'], rolled_six=(dice_val == 6), events=events)
 
-    # Rule 8: rolled 6 → extra turn (even if move was invalid? but we already moved)
-    next_turn(info['room_id'], rolled_six=(dice_val == 6))
+@socketio.on('sync')
+def on_sync(data):
+    # A client that missed a game_delta (see 'v') asks for a fresh snapshot
+    now = time.monotonic()
+    if now - _last_sync.get(request.sid, -SYNC_GAP) < SYNC_GAP: return
+    _last_sync[request.sid] = now
+    info = players.get(request.sid)
+    game = rooms.get(info['room_id']) if info else None
+    if game:
+        emit('game_state', game_to_client(game))
 
 @socketio.on('quick_join')
 def on_quick_join(data):
     sid = request.sid
     if sid in mm_queue: return
-    mm_queue.append(sid)
-    for s in mm_queue:
-        socketio.emit('matchmaking_count', {'count': len(mm_queue)}, to=s)
+    mm_queue[sid] = None
+    join_room(MM_ROOM)
+    socketio.emit('matchmaking_count', {'count': len(mm_queue)}, room=MM_ROOM)
     if len(mm_queue) >= 4:
-        four    = mm_queue[:4]
-        del mm_queue[:4]
+        four = [mm_queue.popitem(last=False)[0] for _ in range(4)]
+        for s in four:
+            leave_room(MM_ROOM, sid=s)
         room_id = create_room('4p')
         game    = rooms[room_id]
-        game['human_slots'] = [0, 1, 2, 3]
+        game['human_mask'] = 0b1111
         for i, s in enumerate(four):
-            game['players'][i]['is_cpu'] = False
-            game['players'][i]['sid']    = s
-            game['filled_slots'].append(i)
+            game['players'][i].is_cpu = False
+            game['players'][i].sid    = s
+            game['filled_mask'] |= 1 << i
             players[s] = {'room_id': room_id, 'player_idx': i}
             join_room(room_id, sid=s)
             socketio.emit('joined',
@@ -590,7 +1093,8 @@ def on_quick_join(data):
 def on_cancel_matchmaking(data):
     sid = request.sid
     if sid in mm_queue:
-        mm_queue.remove(sid)
+        del mm_queue[sid]
+        leave_room(MM_ROOM)
 
 # ─────────────────────────────────────────────
 # ROUTES